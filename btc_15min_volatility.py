@@ -6,8 +6,8 @@ btc_15min_volatility.py
 Este script se ejecuta diariamente (por ejemplo a la medianoche) y:
   1. Descarga los precios de Bitcoin (USD) en intervalos de 1 minuto
      para todo el día anterior usando la API pública de CoinGecko.
-  2. Re-muestrea los datos a intervalos de 15 minutos (último precio
-     de cada cuartohora).
+  2. Alinea los datos a una rejilla de 1 minuto y los agrupa en
+     bloques de 15 minutos (96 cuartos de hora).
   3. Calcula la volatilidad basada en retornos log‑aritmicos de esos
      intervalos de 15 minutos.
   4. Guarda el valor en una tabla SQLite.
@@ -15,6 +15,9 @@ Este script se ejecuta diariamente (por ejemplo a la medianoche) y:
 
 Requisitos: python3, requests, pandas. Instale con:
   pip install requests pandas
+Opcional: numba (acelera el cálculo de la volatilidad), orjson
+(decodifica más rápido la respuesta de CoinGecko) y Pillow (reduce el
+tamaño del PNG enviado).
 
 Para que el mensaje de Telegram funcione, debe:
   • Tener el token del bot configurado en ~/.openclaw/openclaw.json
@@ -25,24 +28,67 @@ Para que el mensaje de Telegram funcione, debe:
 """
 
 import datetime as dt
+import functools
+import hashlib
+import io
 import json
 import os
+import sqlite3
 import sys
-import matplotlib.pyplot as plt
-import tempfile
-import numpy as np
+import threading
+import time
 from pathlib import Path
+
+import numpy as np
 import pandas as pd
+try:
+    from orjson import loads as json_loads
+except ImportError:  # orjson es opcional; json también acepta bytes
+    json_loads = json.loads
 
-import os
-import json
-import requests
-import sqlite3
+# matplotlib, requests y numba se importan bajo demanda: si el script falla
+# en la validación inicial no se paga su tiempo de carga.
 DB_PATH = Path.home() / ".openclaw" / "btc_volatility.sqlite"
-TABLE = "hourly_volatility"
+CACHE_DIR = Path.home() / ".openclaw" / "cg_cache"
+CACHE_TTL = 25 * 3600  # segundos; los precios de un día cerrado no cambian
+CACHE_SLACK = 15 * 60  # la Serie se da por completa si su último precio llega a end_ts - 15 min
+TABLE = "daily_volatility"  # una fila por día con los 96 tramos en float32
 COINGECKO_API = "https://api.coingecko.com/api/v3/coins/bitcoin/market_chart/range"
+COINGECKO_RATE_PER_MIN = 10  # límite inferior documentado de la API pública
 TOKEN = None  # se leerá del archivo de configuración de OpenClaw
 CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")  # debe estar definido en el entorno
+CHART = os.getenv("BTC_VOL_CHART", "1") != "0"  # BTC_VOL_CHART=0: solo texto con sparkline
+SPARK_CHARS = "▁▂▃▄▅▆▇█"
+
+@functools.lru_cache(maxsize=None)
+def _session():
+    """Sesión HTTP compartida (keep-alive); reintenta 429/5xx con backoff."""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=4, pool_maxsize=4,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504])))
+    return session
+
+class TokenBucket:
+    """Limitador de peticiones: espera lo necesario para no superar *rate_per_min*."""
+
+    def __init__(self, rate_per_min: float):
+        self.interval = 60.0 / rate_per_min
+        self.last = 0.0
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            wait = self.last + self.interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self.last = time.monotonic()
+
+_COINGECKO_BUCKET = TokenBucket(COINGECKO_RATE_PER_MIN)
+
 # ------------------------------------------------------------------
 def load_bot_token():
     """Lee el token del bot desde openclaw.json (ruta conocida)."""
@@ -54,77 +100,243 @@ def load_bot_token():
         print(f"❌ No se pudo leer el token del bot: {e}", file=sys.stderr)
         sys.exit(1)
 
-def get_unix_timestamp(dt_obj: dt.datetime) -> int:
-    return int(dt_obj.timestamp())
+def disk_cache(cache_dir: Path, ttl: float, memo_size: int = 8):
+    """Decorador que guarda en disco (pickle) la Serie devuelta por *func*.
+    La clave es el par (start_ts, end_ts); una entrada más antigua que *ttl*
+    segundos se descarta y se vuelve a descargar. Las últimas *memo_size*
+    Series se conservan además en memoria.
+    Solo se guardan Series completas (que llegan hasta cerca de end_ts), para
+    que una descarga vacía o truncada se repita en la siguiente ejecución.
+    """
+    def decorator(func):
+        memo = {}
+
+        def remember(key, series):
+            if len(memo) >= memo_size:
+                memo.pop(next(iter(memo)))  # la más antigua
+            memo[key] = series
+            return series
 
+        @functools.wraps(func)
+        def wrapper(start_ts: int, end_ts: int) -> pd.Series:
+            key = hashlib.sha1(f"{start_ts}:{end_ts}".encode()).hexdigest()
+            if key in memo:
+                return memo[key]
+            path = cache_dir / f"{key}.pkl"
+            try:
+                if time.time() - path.stat().st_mtime < ttl:
+                    return remember(key, pd.read_pickle(path))
+            except Exception:
+                pass  # sin caché o caché ilegible: se descarga de nuevo
+            series = func(start_ts, end_ts)
+            if series.empty or series.index[-1].timestamp() < end_ts - CACHE_SLACK:
+                return series
+            remember(key, series)
+            try:
+                cache_dir.mkdir(parents=True, exist_ok=True)
+                series.to_pickle(path)
+            except Exception as e:
+                print(f"⚠️ No se pudo escribir la caché {path}: {e}", file=sys.stderr)
+            return series
+        return wrapper
+    return decorator
+
+@disk_cache(CACHE_DIR, CACHE_TTL)
 def fetch_price_data(start_ts: int, end_ts: int) -> pd.Series:
     params = {"vs_currency": "usd", "from": start_ts, "to": end_ts}
-    resp = requests.get(COINGECKO_API, params=params, timeout=30)
+    _COINGECKO_BUCKET.take()
+    resp = _session().get(COINGECKO_API, params=params, timeout=30)
     resp.raise_for_status()
-    data = resp.json()["prices"]  # [[ts_ms, price], ...]
-    df = pd.DataFrame(data, columns=["ts_ms", "price_usd"])
-    df["timestamp"] = pd.to_datetime(df["ts_ms"], unit="ms", utc=True)
-    df.set_index("timestamp", inplace=True)
-    # Re‑muestrear a 15 minutos, tomando el último precio de cada ventana
-    return df["price_usd"]
-
-def compute_15min_volatility(series: pd.Series) -> pd.Series:
-    """Calcula la volatilidad (desviación estándar) de los retornos logarítmicos en bloques de 15 min.
-    Devuelve una Serie indexada por el inicio de cada bloque con el valor de volatilidad.
+    data = json_loads(resp.content)["prices"]  # [[ts_ms, price], ...]
+    a = np.asarray(data, dtype=np.float64).reshape(-1, 2)
+    idx = pd.to_datetime(a[:, 0].astype(np.int64), unit="ms", utc=True)
+    return pd.Series(a[:, 1], index=idx, name="price_usd")
+
+def _vol15_numpy(p: np.ndarray, out: np.ndarray):
+    """Escribe en *out* la volatilidad de los 96 bloques a partir de 1440 precios por minuto (ruta NumPy)."""
+    # Retornos por minuto; el primero del día no tiene precio previo
+    r = np.empty(1440)
+    r[0] = np.nan
+    r[1:] = np.diff(np.log(p))
+    r2 = r.reshape(96, 15)
+    # Varianza en dos pasadas (media y luego desviaciones): estable frente a
+    # la cancelación de la fórmula de suma de cuadrados
+    valid = ~np.isnan(r2)
+    n = valid.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(valid, r2, 0.0).sum(axis=1, keepdims=True) / n[:, None]
+        dev = np.where(valid, r2 - mean, 0.0)
+        var = (dev * dev).sum(axis=1) / (n - 1)
+    np.sqrt(var, out=out)
+
+def _vol15_loop(p, out):
+    """Misma cuenta que _vol15_numpy en una sola pasada (log, diff y Welford fusionados)."""
+    prev = np.log(p[0])
+    for b in range(96):
+        m = 0.0
+        m2 = 0.0
+        k = 0
+        for j in range(15):
+            i = b * 15 + j
+            if i == 0:
+                continue
+            cur = np.log(p[i])
+            x = cur - prev
+            prev = cur
+            k += 1
+            d = x - m
+            m += d / k
+            m2 += d * (x - m)
+        out[b] = np.sqrt(m2 / (k - 1)) if k > 1 else np.nan
+
+@functools.lru_cache(maxsize=None)
+def _vol15_kernel():
+    """Con numba se compila el bucle (y se cachea en disco); sin él, la ruta NumPy."""
+    try:
+        from numba import njit
+    except ImportError:  # numba es opcional
+        return _vol15_numpy
+    return njit(cache=True)(_vol15_loop)
+
+def compute_15min_volatility(series: pd.Series, day: dt.date) -> pd.Series:
+    """Calcula la volatilidad (desviación estándar) de los retornos logarítmicos en bloques de 15 min.
+    Devuelve una Serie indexada por el inicio de cada bloque (UTC) de *day* con el valor de volatilidad.
     Los valores NaN se sustituyen por 0.0.
     """
-    log_ret = np.log(series / series.shift(1)).dropna()
-    vol_series = log_ret.resample('15min').std().fillna(0.0)
-    # Asegura 96 valores
-    if len(vol_series) < 96:
-        extra = pd.Series([0.0]*(96 - len(vol_series)), index=pd.date_range(start=vol_series.index[-1] + pd.Timedelta(minutes=15), periods=96 - len(vol_series), freq='15min'))
-        vol_series = pd.concat([vol_series, extra])
-    return vol_series.head(96)
+    if series.empty:
+        raise ValueError(f"No hay precios para {day}; no se calcula la volatilidad")
+    idx = pd.date_range(pd.Timestamp(day), periods=96, freq='15min', tz='UTC')
+    # Salida pre-reservada: siempre 96 tramos
+    out = np.zeros(96, dtype=np.float64)
+    # Alinea a la rejilla completa de 1440 minutos del día
+    grid = pd.date_range(idx[0], periods=1440, freq='1min')
+    p = series.resample('1min').last().reindex(grid).ffill().bfill().to_numpy(dtype=np.float64)
+    try:
+        _vol15_kernel()(p, out)
+    except Exception as e:  # fallo de compilación o caché de numba ilegible
+        print(f"⚠️ Kernel numba no disponible, se usa NumPy: {e}", file=sys.stderr)
+        _vol15_numpy(p, out)
+    np.nan_to_num(out, copy=False, nan=0.0)
+    return pd.Series(out, index=idx)
+
+def connect_db(path: Path = DB_PATH) -> sqlite3.Connection:
+    """Abre la base SQLite con PRAGMAs orientados a escritura (WAL, sin fsync por commit)."""
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")  # ~20 MB
+    return conn
 
 def init_db(conn: sqlite3.Connection):
-    # Elimina tabla antigua (si existe) y la crea con columnas v0‑v95
-    conn.execute(f"DROP TABLE IF EXISTS {TABLE}")
-    cols = ", ".join([f"v{i} REAL" for i in range(96)])
-    sql = f"CREATE TABLE {TABLE} (day TEXT PRIMARY KEY, {cols}, computed_at TIMESTAMP NOT NULL);"
-    conn.execute(sql)
+    # Crea la tabla (day, vols) si no existe (conserva el histórico);
+    # vols guarda los 96 tramos como float32 contiguos (384 bytes por día) y
+    # vol_mean/vol_min/vol_max su resumen, para agregar el histórico en SQL
+    conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {TABLE} ("
+        "day TEXT PRIMARY KEY, vols BLOB NOT NULL, computed_at TIMESTAMP NOT NULL, "
+        "vol_mean REAL, vol_min REAL, vol_max REAL)"
+    )
+    # Tablas creadas antes de existir las columnas de resumen
+    cols = {row[1] for row in conn.execute(f"PRAGMA table_info({TABLE})")}
+    for col in ("vol_mean", "vol_min", "vol_max"):
+        if col not in cols:
+            conn.execute(f"ALTER TABLE {TABLE} ADD COLUMN {col} REAL")
     conn.commit()
 
+_UPSERT_SQL = (
+    f"INSERT OR REPLACE INTO {TABLE} (day, vols, vol_mean, vol_min, vol_max, computed_at) "
+    "VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)"
+)
+
+def _blob_row(day: str, series: pd.Series) -> tuple:
+    """Convierte *series* en la fila (day, vols, mean, min, max); los tramos ausentes se guardan como NaN."""
+    vals = series.to_numpy(dtype=np.float64)[:96]
+    arr = np.full(96, np.nan, dtype=np.float32)
+    arr[:len(vals)] = vals
+    valid = vals[~np.isnan(vals)]
+    if len(valid):
+        stats = (float(valid.mean()), float(valid.min()), float(valid.max()))
+    else:
+        stats = (None, None, None)
+    return (day, memoryview(arr.tobytes()), *stats)
+
 def store_results(conn: sqlite3.Connection, day: str, series: pd.Series):
-    """Inserta una fila con la volatilidad de cada tramo de 15 min.
+    """Inserta (o reemplaza) la fila con la volatilidad de cada tramo de 15 min.
     *series* debe contener 96 valores (uno por cada tramo) y su índice será el comienzo del tramo.
     """
-    # Aseguramos 96 valores; si faltan, completamos con None
-    values = [float(series.iloc[i]) if i < len(series) and not pd.isna(series.iloc[i]) else None for i in range(96)]
-    placeholders = ", ".join(["?" for _ in range(97)])  # 1 day + 96 slots
-    sql = f"INSERT INTO {TABLE} (day, " + ", ".join([f"v{i}" for i in range(96)]) + ", computed_at) "
-    sql += f"VALUES ({placeholders}, CURRENT_TIMESTAMP)"
-    conn.execute(sql, (day, *values))
+    conn.execute(_UPSERT_SQL, _blob_row(day, series))
     conn.commit()
-    # (old insert removed)
 
-def send_telegram_message(token: str, chat_id: str, text: str = None, image_path: str = None):
+def store_many(conn: sqlite3.Connection, rows):
+    """Versión por lotes de store_results para rellenar varios días.
+    *rows* es un iterable de pares (day, series).
+    """
+    conn.executemany(_UPSERT_SQL, (_blob_row(day, series) for day, series in rows))
+    conn.commit()
+
+def load_results(conn: sqlite3.Connection, day: str) -> np.ndarray:
+    """Devuelve los 96 valores (float32) guardados para *day*, o None si no hay fila."""
+    row = conn.execute(f"SELECT vols FROM {TABLE} WHERE day = ?", (day,)).fetchone()
+    return np.frombuffer(row[0], dtype=np.float32) if row else None
+
+def sparkline(values: np.ndarray) -> str:
+    """Representa *values* como una línea de bloques Unicode (un carácter por tramo)."""
+    values = np.nan_to_num(np.asarray(values, dtype=np.float64), nan=0.0)
+    vmax = values.max() if len(values) else 0.0
+    if vmax <= 0:
+        return SPARK_CHARS[0] * len(values)
+    levels = np.clip((values * len(SPARK_CHARS) / vmax).astype(int), 0, len(SPARK_CHARS) - 1)
+    return "".join(SPARK_CHARS[i] for i in levels)
+
+def figure_to_png(canvas) -> bytes:
+    """Renderiza *canvas* (FigureCanvasAgg) a PNG en memoria.
+    Con Pillow instalado la imagen se cuantiza a una paleta de 64 colores y se
+    optimiza, lo que reduce varias veces el tamaño a subir a Telegram.
+    """
+    buf = io.BytesIO()
+    try:
+        from PIL import Image
+    except ImportError:  # Pillow es opcional: PNG RGBA sin cuantizar
+        canvas.print_png(buf)
+        return buf.getvalue()
+    canvas.draw()
+    img = Image.frombuffer("RGBA", canvas.get_width_height(), canvas.buffer_rgba(), "raw", "RGBA", 0, 1)
+    img = img.convert("RGB").quantize(colors=64)
+    img.save(buf, format="PNG", optimize=True)
+    return buf.getvalue()
+
+def history_stats(conn: sqlite3.Connection, day: str) -> tuple:
+    """Devuelve (días, media, mínimo, máximo) de la volatilidad de los días anteriores a *day*.
+    La agregación se hace en SQLite sobre las columnas de resumen, sin cargar los vectores.
+    """
+    return conn.execute(
+        f"SELECT COUNT(vol_mean), AVG(vol_mean), MIN(vol_min), MAX(vol_max) FROM {TABLE} WHERE day < ?",
+        (day,),
+    ).fetchone()
+
+def send_telegram_message(token: str, chat_id: str, text: str = None, image_bytes: bytes = None):
     """Envía un mensaje de texto o una foto a Telegram.
-    Si *image_path* está definido se envía la foto con *caption* opcional (text).
+    Si *image_bytes* (PNG en memoria) está definido se envía la foto con *caption* opcional (text).
     """
     # Decide endpoint según si hay imagen
-    if image_path:
+    if image_bytes:
         url = f"https://api.telegram.org/bot{token}/sendPhoto"
     else:
         url = f"https://api.telegram.org/bot{token}/sendMessage"
     payload = {"chat_id": chat_id}
     if text:
-        if image_path:
+        if image_bytes:
             payload["caption"] = text
         else:
             payload["text"] = text
             payload["parse_mode"] = "Markdown"
     try:
-        if image_path:
-            with open(image_path, "rb") as f:
-                files = {"photo": f}
-                r = requests.post(url, data=payload, files=files, timeout=10)
+        if image_bytes:
+            files = {"photo": ("vol.png", image_bytes, "image/png")}
+            r = _session().post(url, data=payload, files=files, timeout=10)
         else:
-            r = requests.post(url, data=payload, timeout=10)
+            r = _session().post(url, data=payload, timeout=10)
         r.raise_for_status()
         print("✅ Notificación enviada a Telegram")
     except Exception as e:
@@ -137,51 +349,46 @@ def main():
         print("❌ La variable de entorno TELEGRAM_CHAT_ID no está definida.", file=sys.stderr)
         sys.exit(1)
 
-    today_utc = dt.datetime.utcnow().date()
-    target_day = today_utc - dt.timedelta(days=1)
-    start_dt = dt.datetime.combine(target_day, dt.time.min, tzinfo=dt.timezone.utc)
-    end_dt = dt.datetime.combine(target_day, dt.time.max, tzinfo=dt.timezone.utc)
-    start_ts = get_unix_timestamp(start_dt)
-    end_ts = get_unix_timestamp(end_dt)
+    # Día anterior en UTC a partir del número de día desde la época
+    epoch_day = int(time.time()) // 86400 - 1
+    target_day = dt.date(1970, 1, 1) + dt.timedelta(days=epoch_day)
+    start_ts = epoch_day * 86400
+    end_ts = start_ts + 86399
 
     try:
         prices_15min = fetch_price_data(start_ts, end_ts)
-        vol_series = compute_15min_volatility(prices_15min)
-        conn = sqlite3.connect(DB_PATH)
+        vol_series = compute_15min_volatility(prices_15min, target_day)
+        conn = connect_db()
         init_db(conn)
         store_results(conn, target_day.isoformat(), vol_series)
-        # Recuperar la fila insertada para incluir datos en el mensaje
-        row = conn.execute(f"SELECT * FROM {TABLE} WHERE day = ?", (target_day.isoformat(),)).fetchone()
+        hist_days, hist_mean, hist_min, hist_max = history_stats(conn, target_day.isoformat())
+        conn.close()
         # Preparar una pequeña tabla de los primeros 5 tramos para el mensaje
-        snippet_vals = []
-        for i in range(5):
-            val = row[1 + i]
-            snippet_vals.append(f"v{i}:{val:.6f}" if val is not None else f"v{i}:N/A")
+        head = vol_series.iloc[:5].to_numpy()
+        snippet_vals = [f"v{i}:{v:.6f}" if not np.isnan(v) else f"v{i}:N/A" for i, v in enumerate(head)]
         snippet_text = ", ".join(snippet_vals)
-        conn.close()
 
-
-        # Generar gráfico de volatilidad por ventana de 15 min
-        fig, ax = plt.subplots(figsize=(12, 4))
-        ax.plot(vol_series.index, vol_series.values, marker='o', linestyle='-')
-        ax.set_title(f"Volatilidad BTC (15 min) – {target_day}")
-        ax.set_xlabel('Hora (UTC)')
-        ax.set_ylabel('Volatilidad (σ)')
-        ax.grid(True)
-        # Guardar en archivo temporal
-        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp:
-            fig.savefig(tmp.name, bbox_inches='tight')
-            plot_path = tmp.name
-        plt.close(fig)
-
-        msg = f"*Volatilidad BTC (15 min) – {target_day}*\nVentanas: `{len(vol_series)}`\nVolatilidad media: `{vol_series.mean():.6f}`\nDatos (primeros 5 tramos): `{snippet_text}`"
-        # Envío de foto con caption (el caption lleva el mismo texto)
-        send_telegram_message(TOKEN, CHAT_ID, text=msg, image_path=plot_path)
-        # Opcional: eliminar el archivo temporal
-        try:
-            os.remove(plot_path)
-        except Exception:
-            pass
+        msg = f"*Volatilidad BTC (15 min) – {target_day}*\nVentanas: `{len(vol_series)}`\nVolatilidad media: `{vol_series.mean():.6f}`\nDatos (primeros 5 tramos): `{snippet_text}`\nPerfil: `{sparkline(vol_series.to_numpy())}`"
+        if hist_days:
+            msg += f"\nHistórico ({hist_days} días): media `{hist_mean:.6f}`, mín `{hist_min:.6f}`, máx `{hist_max:.6f}`"
+        if not CHART:
+            # Sin gráfico: solo texto (no se importa matplotlib ni se sube PNG)
+            send_telegram_message(TOKEN, CHAT_ID, text=msg)
+        else:
+            # Generar gráfico de volatilidad por ventana de 15 min
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            fig = Figure(figsize=(12, 4))
+            ax = fig.subplots()
+            ax.plot(vol_series.index, vol_series.values, marker='o', linestyle='-')
+            ax.set_title(f"Volatilidad BTC (15 min) – {target_day}")
+            ax.set_xlabel('Hora (UTC)')
+            ax.set_ylabel('Volatilidad (σ)')
+            ax.grid(True)
+            fig.tight_layout()
+            png = figure_to_png(FigureCanvasAgg(fig))
+            # Envío de foto con caption (el caption lleva el mismo texto)
+            send_telegram_message(TOKEN, CHAT_ID, text=msg, image_bytes=png)
         print(f"[{dt.datetime.now().isoformat()}] ✅ Volatilidad 15 min del {target_day} = {vol_series.mean():.6f}")
     except Exception as e:
         print(f"[{dt.datetime.now().isoformat()}] ❌ Error: {e}", file=sys.stderr)